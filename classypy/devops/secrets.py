@@ -1,4 +1,8 @@
 import os
+import os.path as op
+from functools import lru_cache
+from itertools import groupby
+from pathlib import Path
 
 from ..util.dirs import caller_dir
 
@@ -9,51 +13,108 @@ REGION_MAP = {
 
 class Secrets(dict):
     """Class that facilitates hiding the printing of secrets."""
-    def __repr__(self):
-        return '<%s.%s object at %s>' % (
-            self.__class__.__module__,
-            self.__class__.__name__,
-            hex(id(self))
-        )
+    # object's repr is `<module.Class object at 0x...>`, without dict contents.
+    __repr__ = object.__repr__
+    __str__ = object.__repr__
 
 
 def _key_prefix(key):
     """Return the string before the first '_'."""
-    return key.split('_')[0]
+    return key.partition('_')[0]
 
 
 def write_dotenv(env_file, secrets, section_split=""):
     """Create a (sectioned) dotenv file from a secrets dict."""
-    keys = secrets.keys()
-    if section_split:
-        keys = sorted(keys)
+    keys = sorted(secrets) if section_split else list(secrets)
+
+    lines = []
+    for gi, (prefix, group_keys) in enumerate(groupby(keys, key=_key_prefix)):
+        if gi and prefix and section_split:
+            lines.append(section_split)
+        lines.extend("%s = %s\n" % (key, secrets[key]) for key in group_keys)
 
     with open(env_file, 'w') as fp:
-        prev_prefix = ''
-        for key in keys:
-            if _key_prefix(key) != prev_prefix:
-                prev_prefix = _key_prefix(key)
-                if prev_prefix:
-                    fp.write(section_split)
-            fp.write("%s = %s\n" % (key, secrets[key]))
+        fp.write(''.join(lines))
+
+
+def _unquote_dotenv_value(value):
+    """Return a dotenv value without quotes or trailing comment.
+
+    Double-quoted values support backslash escapes (\\", \\\\, \\n, \\t); single-quoted values are literal.
+    """
+    quote = value[:1]
+    if quote == "'" and value.find(quote, 1) > 0:
+        return value[1:value.find(quote, 1)]
+
+    if quote == '"':
+        escapes = {'n': '\n', 't': '\t', '"': '"', '\\': '\\'}
+        chars, ci = [], 1
+        while ci < len(value):
+            char = value[ci]
+            if char == '\\' and ci + 1 < len(value):
+                next_char = value[ci + 1]
+                chars.append(escapes.get(next_char, '\\' + next_char))
+                ci += 2
+                continue
+            if char == '"':
+                # Closing quote; anything after it is dropped.
+                return ''.join(chars)
+            chars.append(char)
+            ci += 1
+        # Unterminated quote: fall through and treat as unquoted.
+
+    # Unquoted: ` #` starts an inline comment.
+    return value.split(' #', 1)[0].split('\t#', 1)[0].strip()
+
+
+def _parse_dotenv(env_file):
+    """Parse `[export] KEY = value` lines of a dotenv file into a dict (no variable expansion).
+
+    Lines without a key (e.g. `=value`) are skipped.
+    """
+    values = {}
+    with open(env_file) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, _, value = line.partition('=')
+            key, value = key.strip(), value.strip()
+            if key == 'export' or key.startswith('export '):
+                key = key[len('export'):].strip()
+            if not key:
+                continue
+            values[key] = _unquote_dotenv_value(value)
+    return values
 
 
 def filter_dict(d, allowed_keys):
-    return {k: v for k, v in d.items()
-            if allowed_keys is None or k in allowed_keys}
+    if allowed_keys is None:
+        return dict(d)
+    # Convert to a set once; membership tests are O(1) and d's key order is kept.
+    allowed_keys = set(allowed_keys)
+    return {k: v for k, v in d.items() if k in allowed_keys}
+
+
+@lru_cache(maxsize=32)
+def _find_dotenv(path):
+    for dir_path in [path] + list(path.parents):
+        env_file = dir_path / '.env'
+        if env_file.is_file():
+            return str(env_file)
+    return None
 
 
 def find_dotenv(search_path):
-    import dotenv
+    """Return the nearest .env file in search_path or its ancestors (cached per path), or None.
 
-    cur_path = os.getcwd()
-    env_file = None
-    try:
-        os.chdir(search_path)
-        env_file = dotenv.find_dotenv(usecwd=True)
-    finally:
-        os.chdir(cur_path)
-    return env_file
+    Misses are cached too; call find_dotenv.cache_clear() to pick up a newly created .env.
+    """
+    # Resolve before caching, so relative paths stay correct if the cwd changes.
+    return _find_dotenv(Path(search_path).resolve())
+
+
+find_dotenv.cache_clear = _find_dotenv.cache_clear
 
 
 def _region_from_credstash_tablename(credstash_table):
@@ -77,9 +138,11 @@ def find_secrets(env_file=None, credstash_table=None, allowed_keys=None,
 
     # Fill with local/.env secrets (override remote)
     env_file = env_file or find_dotenv(search_path=caller_dir(frames_above=1))
-    if env_file:
-        import dotenv
-        dotenv.load_dotenv(env_file, verbose=verbose > 0, override=True)
+    if env_file and not op.isfile(env_file):
+        if verbose > 0:
+            print("File doesn't exist: {env_file}".format(env_file=env_file))
+    elif env_file:
+        os.environ.update(_parse_dotenv(env_file))
         new_secrets = filter_dict(os.environ, allowed_keys=allowed_keys)
         secrets.update(new_secrets)
 
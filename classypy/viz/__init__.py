@@ -1,15 +1,12 @@
-from collections import OrderedDict
-
-
 def classy_colors():
-    colors = OrderedDict()
-    colors['pink'] = "#F77462"
-    colors['blue'] = "#42C2F6"
-    colors['green'] = "#50D1BF"
-    colors['dark_grey'] = "#44505D"
-    colors['light_grey'] = "#828B94"
-    colors['black'] = "#000000"
-    return colors
+    return {
+        'pink': "#F77462",
+        'blue': "#42C2F6",
+        'green': "#50D1BF",
+        'dark_grey': "#44505D",
+        'light_grey': "#828B94",
+        'black': "#000000",
+    }
 
 
 def classy_colorscale():
@@ -1,44 +1,111 @@
 """
 Produce the Giving Tuesday visualizations.
 """
+import glob
+import hashlib
+import os
 import os.path as op
+import pickle
 import sys
-import warnings
-from collections import defaultdict
+import tempfile
+from functools import lru_cache, wraps
 
 import numpy as np
 import pandas as pd
-import plotly as py
-import plotly.graph_objs as go
-import us
 
 # Use local classypy until we can fully publish.
 sys.path = [op.join(op.dirname(op.abspath(__file__)), '..', 'classypy')] + list(sys.path)  # isort:stay
-from classypy import viz
-from classypy.devops import find_secrets
 from classypy.util.dirs import data_dir, reports_dir
 
+# Pickled figures, keyed by plot function, this file's source and input data.
+# Only the latest entry per plot function is kept; delete the dir to clear it.
+_FIGURE_CACHE_DIR = op.join(op.dirname(op.abspath(__file__)), '..', '.cache', 'figs')
 
-def save_plot(fig, output_path, save_remote=False, sharing="public"):
-    """Save a plot either locally, or to a plotly account."""
-    if save_remote:
-        py.plotly.iplot(fig, filename=op.basename(output_path.replace(".html", "")), sharing=sharing)
-    else:
-        py.offline.plot(fig, filename=output_path)
+# Event (from the trajectory label) => display name; unlisted events map to ''.
+_EVENT_LABELS = {
+    'gt 2015': '2015',
+    'gt 2016': '2016',
+    'eoy 2015': '2015',
+    'eoy 2016': '2016',
+    'hurricane harvey': 'Hurricane Harvey',
+    'louisiana flooding': 'Louisiana Flooding',
+}
 
 
-def state_name_lookup(abbr):
-    """Return a state name, or None"""
-    state = us.states.lookup(abbr)
-    return state and state.name or None
+@lru_cache(maxsize=None)
+def _abbr_to_name():
+    """State abbreviation => name, for a hashtable map rather than per-row lookups."""
+    import us
+    return {state.abbr: state.name for state in us.states.STATES_AND_TERRITORIES + [us.states.DC]}
 
 
+def save_plot(fig, output_path, save_remote=False, sharing="public", include_plotlyjs="cdn"):
+    """Save a plot either locally, or to a plotly account.
+
+    Local plots link plotly.js from the CDN by default, rather than inlining the full bundle.
+    """
+    import plotly as py
+
+    if save_remote:
+        py.plotly.iplot(fig, filename=op.basename(output_path.replace(".html", "")), sharing=sharing)
+    else:
+        py.offline.plot(fig, filename=output_path, include_plotlyjs=include_plotlyjs)
+
+
+def _cache_remote_figure(plot_func):
+    """On remote saves, reuse the pickled figure built by identical code from identical input data."""
+    # Hash this module's source, so edits to the plot code (or its helpers) invalidate the cache.
+    # Changes to classypy (e.g. viz colors) aren't tracked; clear the cache dir after those.
+    with open(op.abspath(__file__), "rb") as fp:
+        source_hash = hashlib.sha1(fp.read()).hexdigest()
+
+    @wraps(plot_func)
+    def wrapper(df, output_path=None, save_remote=False):
+        if not save_remote:
+            return plot_func(df, output_path=output_path, save_remote=save_remote)
+
+        # Hash before plotting; plot functions modify df.
+        df_hash = hashlib.sha1(source_hash.encode())
+        df_hash.update(",".join(df.columns).encode())
+        df_hash.update(pd.util.hash_pandas_object(df).values.tobytes())
+        cache_path = op.join(_FIGURE_CACHE_DIR, "%s-%s.pkl" % (plot_func.__name__, df_hash.hexdigest()))
+
+        if op.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as fp:
+                    fig = pickle.load(fp)
+            except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+                # Truncated file, or pickled by other library versions; rebuild it.
+                fig = None
+            if fig is not None:
+                save_plot(fig, output_path=output_path, save_remote=save_remote)
+                return fig
+
+        fig = plot_func(df, output_path=output_path, save_remote=save_remote)
+        os.makedirs(_FIGURE_CACHE_DIR, exist_ok=True)
+        for stale_path in glob.glob(op.join(_FIGURE_CACHE_DIR, "%s-*.pkl" % plot_func.__name__)):
+            os.remove(stale_path)
+
+        # Write then rename, so an interrupted run can't leave a partial pickle behind.
+        with tempfile.NamedTemporaryFile(dir=_FIGURE_CACHE_DIR, suffix=".tmp", delete=False) as fp:
+            pickle.dump(fig, fp)
+        os.replace(fp.name, cache_path)
+        return fig
+    return wrapper
+
+
+@_cache_remote_figure
 def plot_map(df, output_path=None, save_remote=False):
     """USA Chloropleth map, via https://plot.ly/python/choropleth-maps/"""
-    df["z"] = np.round(100.0 * df["gtv_normalized"] * 52.0 / df["gtv_normalized"].sum(), 1)
+    from classypy import viz
+
+    # Percent of the 52-state mean, with the scale folded into one multiply.
+    # nansum, as Series.sum did, so a missing state doesn't blank the whole map.
+    gtv = df["gtv_normalized"].to_numpy()
+    df["z"] = np.round(gtv * (5200.0 / np.nansum(gtv)), 1)
 
-    # Add state name
-    df["state_name"] = df["state"].map(state_name_lookup)
+    # Add state name (unknown abbreviations fall back to the abbreviation in hover text)
+    df["state_name"] = df["state"].map(_abbr_to_name())
 
     colorbar_ticks = [25, 100, 200, 300, 400]  # determined ad-hoc
 
@@ -55,7 +122,7 @@ def plot_map(df, output_path=None, save_remote=False):
         ),
         locationmode="USA-states",
         locations=df["state"],
-        text=df.apply(lambda row: "{name}<br>{pct}%".format(name=row["state_name"], pct=row["z"]), axis=1),
+        text=df["state_name"].fillna(df["state"]).astype(str) + "<br>" + df["z"].astype(str) + "%",
         hoverinfo="text",
         z=df["z"],
     )]
@@ -70,118 +137,110 @@ def plot_map(df, output_path=None, save_remote=False):
         ),
         width=700,
         height=500,
+        uirevision="map",
     )
 
     fig = dict(data=data, layout=layout)
     save_plot(fig, output_path=output_path, save_remote=save_remote)
+    return fig
 
 
+@_cache_remote_figure
 def plot_lines(lines_df, output_path=None, save_remote=False):
     """Line chart showing fundraising trajectory over time."""
-    # Label column has category and specific event.
+    import plotly as py
+    import plotly.graph_objs as go
+    from plotly_resampler import FigureResampler
+
+    from classypy import viz
 
-    event_labels = defaultdict(lambda: '')
-    event_labels.update({
-        'gt 2015': '2015',
-        'gt 2016': '2016',
-        'eoy 2015': '2015',
-        'eoy 2016': '2016',
-        'hurricane harvey': 'Hurricane Harvey',
-        'louisiana flooding': 'Louisiana Flooding',
-    })
-
-    lines_df["category"] = lines_df["label"].map(
-        lambda lbl: lbl.split(":")[0])
-    lines_df["event"] = lines_df["label"].map(
-        lambda lbl: event_labels[lbl.split(":")[1].strip()])
+    # Label column has category and specific event.
+    label_parts = lines_df["label"].str.split(":", n=1, expand=True)
+    lines_df["category"] = label_parts[0]
+    lines_df["event"] = label_parts[1].str.strip().map(_EVENT_LABELS).fillna("")
     lines_df["pct_transactions"] *= 100
 
-    event_dfs = (
-        lines_df[lines_df["label"].isin(("gt: gt 2015", "gt: gt 2016"))],
-        lines_df[lines_df["label"].isin(("eoy: eoy 2015", "eoy: eoy 2016"))],
-        lines_df[lines_df["label"].isin(("disaster: hurricane harvey", "disaster: louisiana flooding"))],
-    )
+    # Split by category in one pass (missing categories get an empty panel),
+    # then keep only the labelled events within each group.
+    grouped = dict(list(lines_df.groupby("category")))
+    event_dfs = [grouped.get(category, lines_df.iloc[:0]) for category in ("gt", "eoy", "disaster")]
+    event_dfs = [event_df[event_df["event"] != ""] for event_df in event_dfs]
 
     # gt is greatest
     ymax = event_dfs[0]["pct_transactions"].max()
 
-    # Create traces
-    event_traces = [[go.Scatter(
+    # Create traces. The hover label carries the event name, since the resampler
+    # prefixes the names of downsampled traces with "[R]".
+    event_traces = [[go.Scattergl(
         x=trace_df["diff"].values,
         y=trace_df["pct_transactions"].values,
         mode="lines",
-        legendgroup=trace_df["event"].unique()[0],
-        name=trace_df["event"].unique()[0],
+        legendgroup=event,
+        name=event,
+        hovertemplate="(%{x}, %{y})<extra>" + event + "</extra>",
         line=dict(width=4, color=["#f77462", "#50d1bf"][ti]),
-    ) for ti, (_, trace_df) in enumerate(event_df.groupby("event"))] for event_df in event_dfs]
+    ) for ti, (event, trace_df) in enumerate(event_df.groupby("event"))] for event_df in event_dfs]
 
-    fig = py.tools.make_subplots(rows=1, cols=3, print_grid=False, subplot_titles=(
-        "Giving Tuesday", "December 31", "Disaster Relief"))
+    # Downsample long traces, so only ~canvas-width points are serialized.
+    # Without a Dash server, saved HTML is a fixed 1000-point-per-trace view (zoom won't re-aggregate).
+    fig = FigureResampler(py.tools.make_subplots(rows=1, cols=3, print_grid=False, subplot_titles=(
+        "Giving Tuesday", "December 31", "Disaster Relief")),
+        default_n_shown_samples=1000, show_mean_aggregation_size=False)
 
     for ei in range(3):
-        fi, xaxis, yaxis = ei + 1, "xaxis%d" % (ei + 1), "yaxis%d" % (ei + 1)
-
-        # Lay out the axes
-        fig["layout"][xaxis].update(
-            showgrid=True)
-        fig["layout"][yaxis].update(
-            range=[0, ymax],
-            showgrid=True,
-            ticksuffix="%")
-
-        if ei == 1:
-            fig["layout"][xaxis].update(
-                title="Days after event")
-        if ei == 0:
-            fig["layout"][yaxis].update(
-                title="% of 13 day total")
-
         for sc in event_traces[ei]:
             # Add the trace
-            fig.append_trace(sc, 1, fi)
+            fig.append_trace(sc, 1, ei + 1)
+
+    # Lay out the axes, all in one layout update.
+    layout_updates = {}
+    for ei in range(3):
+        layout_updates["xaxis%d" % (ei + 1)] = dict(showgrid=True)
+        layout_updates["yaxis%d" % (ei + 1)] = dict(range=[0, ymax], showgrid=True, ticksuffix="%")
+    layout_updates["xaxis2"]["title"] = "Days after event"
+    layout_updates["yaxis1"]["title"] = "% of 13 day total"
 
-    fig["layout"].update(
+    fig.update_layout(
         title="Daily Fundraising During Events",
         font=viz.classy_font(),
         showlegend=False,
         width=900,
         height=440,
+        **layout_updates
     )
     save_plot(fig, output_path=output_path, save_remote=save_remote)
+    return fig
 
 
+@_cache_remote_figure
 def plot_bars(df, output_path=None, save_remote=False):
     """Show bar plot of various metrics, grouped by event type."""
+    import plotly.graph_objs as go
+
+    from classypy import viz
+
     # Filter to just the events we want
-    df = df[df["supporter_class"].isin(("#GT", "EOY", "Harvey"))]
-    df["supporter_class"] = df["supporter_class"].map(lambda lbl: {
+    event_names = {
         "#GT": "Giving Tuesday 2016",
         "EOY": "December 31, 2016",
         "Harvey": "Hurricane Harvey",
-    }[lbl])
-
-    # Massage data to percentages of what we want.
-    df["donor_retention"] = 100 * (1.0 - df["pct_ended_on_this_date"])
-    df["pct_multi_gave"] *= 100.0
-    df["pct_fundraising_afterwards"] *= 100.0
-
-    # Only keep data we want, with names we want.
-    df = df.set_index("supporter_class")
-    df = df[["donor_retention", "pct_multi_gave", "pct_fundraising_afterwards"]]
-    df = df.rename(columns={
-        "donor_retention": "New Donor<br>Retention",
-        "pct_multi_gave": "Donors Giving<br>Multiple Times<br>During Event",
-        "pct_fundraising_afterwards": "Donors Becoming<br>Fundraisers Within<br>90 Days"
-    })
+    }
+    df = df[df["supporter_class"].isin(event_names)]
 
+    # Build the percentages we want, with names we want, in one frame.
     # Transpose, so we can grab by event as key.
-    df = df.T
+    df = pd.DataFrame({
+        "New Donor<br>Retention": 100.0 * (1.0 - df["pct_ended_on_this_date"].values),
+        "Donors Giving<br>Multiple Times<br>During Event": 100.0 * df["pct_multi_gave"].values,
+        "Donors Becoming<br>Fundraisers Within<br>90 Days": 100.0 * df["pct_fundraising_afterwards"].values,
+    }, index=df["supporter_class"].map(event_names).values).T
 
+    colors = list(viz.classy_colors().values())
     data = [go.Bar(
-        x=df[event_name].keys(),
-        y=df[event_name].values,
+        x=df[event_name].index.to_numpy(),
+        y=df[event_name].to_numpy(),
         name=event_name,
-        marker=dict(color=list(viz.classy_colors().values())[ei]),
+        marker=dict(color=colors[ei]),
     ) for ei, event_name in enumerate(df.columns)]
 
     layout = go.Layout(
@@ -197,6 +256,7 @@ def plot_bars(df, output_path=None, save_remote=False):
 
     fig = go.Figure(data=data, layout=layout)
     save_plot(fig, output_path=output_path, save_remote=save_remote)
+    return fig
 
 
 if __name__ == "__main__":
@@ -212,6 +272,10 @@ if __name__ == "__main__":
     plots = args.pop("plots").split(",")
 
     if args["save_remote"]:
+        import plotly as py
+
+        from classypy.devops import find_secrets
+
         secrets = find_secrets()
         py.tools.set_credentials_file(
             username=secrets["PLOTLY_USERNAME"], api_key=secrets["PLOTLY_API_KEY"])
@@ -234,14 +298,22 @@ if __name__ == "__main__":
 
     # Plot plots
     if "map" in plots:
-        plot_map(pd.read_csv(paths["csv_path"]["map"]), output_path=paths["output_path"]["map"], **args)
+        map_df = pd.read_csv(
+            paths["csv_path"]["map"], usecols=["state", "gtv_normalized"],
+            dtype={"state": str, "gtv_normalized": np.float32})
+        plot_map(map_df, output_path=paths["output_path"]["map"], **args)
 
     # Line charts
     if "lines" in plots:
-        plot_lines(pd.read_csv(paths["csv_path"]["lines"]), output_path=paths["output_path"]["lines"], **args)
+        lines_df = pd.read_csv(
+            paths["csv_path"]["lines"], usecols=["label", "diff", "pct_transactions"],
+            dtype={"label": str})
+        plot_lines(lines_df, output_path=paths["output_path"]["lines"], **args)
 
     # Bar charts
     if "bars" in plots:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            plot_bars(pd.read_csv(paths["csv_path"]["bars"]), output_path=paths["output_path"]["bars"], **args)
+        bars_df = pd.read_csv(
+            paths["csv_path"]["bars"], usecols=[
+                "supporter_class", "pct_ended_on_this_date", "pct_multi_gave", "pct_fundraising_afterwards"],
+            dtype={"supporter_class": str})
+        plot_bars(bars_df, output_path=paths["output_path"]["bars"], **args)